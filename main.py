@@ -1,22 +1,82 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, model_validator
 import google.generativeai as genai
-from datetime import datetime
-from typing import Optional, Literal, Dict, List
+import asyncio
+import hashlib
+import json
+import threading
+from cachetools import LRUCache
+from contextlib import asynccontextmanager
+from datetime import date
+from functools import lru_cache
+from typing import Optional, Literal
 from dotenv import load_dotenv
 import os
+import redis.asyncio as redis
+from anyio import CapacityLimiter
+from anyio.lowlevel import RunVar
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.status import HTTP_200_OK
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
+from jinja2 import Environment, BaseLoader
+from redisvl.extensions.cache.llm import SemanticCache
+from redisvl.utils.vectorize import HFTextVectorizer
 
 load_dotenv()
-app = FastAPI(title="Enhanced Support System and Complaint Generator")
+
+# Caps in-flight Gemini work so traffic spikes queue here instead of fanning
+# straight into provider 429s; raise until the 429 rate climbs
+_gemini_sem = asyncio.Semaphore(int(os.getenv('GEMINI_CONCURRENCY', '32')))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    RunVar("_default_thread_limiter").set(CapacityLimiter(64))
+    # Build the shared async Gemini client once at startup: its grpc.aio
+    # channel is a persistent HTTP/2 connection that multiplexes every
+    # concurrent call, so no request pays client construction or TLS setup
+    genai.client.get_default_generative_async_client()
+    yield
+
+
+app = FastAPI(
+    title="Enhanced Support System and Complaint Generator",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 genai.configure(api_key=os.getenv('API_KEY'))
 model = genai.GenerativeModel('gemini-pro')
 
-# Store chat histories in memory (session_id -> messages)
-chat_histories: Dict[str, List[dict]] = {}
+# Semantic cache for support-chat responses: near-duplicate opening messages
+# ("hi"/"hello"/"i need help") skip the Gemini round-trip entirely
+llmcache = SemanticCache(
+    name="support_chat",
+    redis_url=os.getenv('REDIS_URL', 'redis://localhost:6379'),
+    distance_threshold=0.1,
+    ttl=3600,
+    vectorizer=HFTextVectorizer("redis/langcache-embed-v1"),
+)
+
+# Chat histories live in Redis (bounded lists with a TTL) so memory stays
+# flat and sessions survive reloads / multiple uvicorn workers
+r = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'), decode_responses=True)
+
+
+async def _store_turn(key: str, user_text: str, bot_text: str) -> None:
+    # RPUSH + LTRIM + EXPIRE fused into one round-trip: LTRIM caps the list
+    # at 50 entries, EXPIRE bounds the session lifetime to a day
+    pipe = r.pipeline()
+    pipe.rpush(
+        key,
+        json.dumps({"text": user_text, "isUser": True}),
+        json.dumps({"text": bot_text, "isUser": False}),
+    )
+    pipe.ltrim(key, -50, -1)
+    pipe.expire(key, 86400)
+    await pipe.execute()
 
 app.add_middleware(
     CORSMiddleware,
@@ -43,17 +103,25 @@ class ComplaintInfo(BaseModel):
     relationship_to_victim: Optional[str]
     filing_authority: str = Field(..., description="Name and title of the filing authority")
     filing_authority_address: str = Field(..., description="Complete address of the filing authority")
-    incident_details: str
+    incident_details: str = Field(..., max_length=8000)
     date_of_incident: str
     time_of_incident: str = Field(..., description="Approximate time of the incident")
     location_of_incident: str = Field(..., description="Specific location where the incident occurred")
-    injuries_sustained: Optional[str]
-    witness_information: Optional[str]
-    evidence_description: Optional[str]
+    injuries_sustained: Optional[str] = Field(..., max_length=4000)
+    witness_information: Optional[str] = Field(..., max_length=4000)
+    evidence_description: Optional[str] = Field(..., max_length=4000)
+
+    @model_validator(mode="after")
+    def _require_victim_details(self):
+        if self.filing_type == "third_party" and not (
+            self.victim_name and self.victim_address and self.relationship_to_victim
+        ):
+            raise ValueError("Third-party complaints require victim name, address, and relationship details")
+        return self
 
 class SupportMessage(BaseModel):
-    message: str
-    session_id: str
+    message: str = Field(..., min_length=1, max_length=2000)
+    session_id: str = Field(..., min_length=1, max_length=128)
 
 class ChatHistory(BaseModel):
     session_id: str
@@ -80,30 +148,49 @@ Based on the user's message and context from the previous conversation, provide
 
 
 COMPLAINT_LETTER_TEMPLATE = """
-{current_date}
-
-{complainant_name}
-{complainant_address}
-{contact_section}
-
-{filing_authority}
-{filing_authority_address}
+{{ current_date }}
+
+{{ complainant_name }}
+{{ complainant_address }}
+{% if complainant_email %}
+{{ complainant_email }}
+{% endif %}
+{% if complainant_contact %}
+{{ complainant_contact }}
+{% endif %}
+{% if not complainant_email and not complainant_contact %}
+Contact information provided separately
+{% endif %}
+
+{{ filing_authority }}
+{{ filing_authority_address }}
 
 Subject: Formal Domestic Violence Complaint
 
-Dear {authority_title},
+Dear {{ authority_title }},
 
-I am writing to formally report a case of domestic violence that occurred on {incident_date} at {incident_time} in {incident_location}. {filing_capacity}
+I am writing to formally report a case of domestic violence that occurred on {{ incident_date }} at {{ incident_time }} in {{ incident_location }}. \
+{% if filing_type == "third_party" %}
+I am filing this complaint on behalf of {{ victim_name }}, as their {{ relationship_to_victim }}. I have direct knowledge of the incidents described herein and am deeply concerned for their safety and well-being.
+{% else %}
+I am the direct victim of the incidents described in this complaint.
+{% endif %}
 
 Incident Details:
 
-{incident_narrative}
+{{ incident_narrative }}
+
+{% if injuries %}
+Injuries Sustained:
 
-{injuries_section}
+{{ injuries }}
 
-{evidence_section}
+{% endif %}
+Supporting Evidence:
+{{ evidence }}
 
-{witness_section}
+Witness Information:
+{{ witnesses }}
 
 Request for Action:
 
@@ -111,124 +198,111 @@ Request for Action:
 2. Thorough investigation of the reported incidents
 3. Appropriate legal action based on the investigation findings
 4. Regular updates on the case progress
-{additional_requests}
+{% if filing_type == "self" %}
+5. Provision of necessary support services and resources
+{% endif %}
 
-{confidentiality_statement}
+I request that my personal information and the details of this complaint be handled with strict confidentiality to ensure my safety and protection.
 
 Thank you for your immediate attention to this serious matter.
 
 Respectfully,
-{complainant_name}
-{contact_details}
+{{ complainant_name }}
+{% if complainant_contact %}
+Contact: {{ complainant_contact }}
+{% endif %}
+{% if filing_type == "third_party" %}
 
-{victim_information}
+Victim Information:
+Name: {{ victim_name }}
+Address: {{ victim_address }}
+{% endif %}
 """
 
-def create_contact_section(info: ComplaintInfo) -> str:
-    contact_parts = []
-    if info.complainant_email:
-        contact_parts.append(info.complainant_email)
-    if info.complainant_contact:
-        contact_parts.append(info.complainant_contact)
-    return "\n".join(contact_parts) if contact_parts else "Contact information provided separately"
-
-def create_injuries_section(injuries: Optional[str]) -> str:
-    if not injuries:
-        return ""
-    return f"""
-Injuries Sustained:
-
-{injuries}
-"""
+# Compiled once at import; str.format reparsed the template on every request
+_env = Environment(loader=BaseLoader(), autoescape=False, trim_blocks=True, lstrip_blocks=True)
+_LETTER_TPL = _env.from_string(COMPLAINT_LETTER_TEMPLATE)
+
+# Rendering is deterministic given the ComplaintInfo and the date, so repeat
+# submissions are served from a small LRU of finished letters; the lock keeps
+# it consistent across the threadpool workers this handler runs on
+_letter_cache: "LRUCache[str, str]" = LRUCache(maxsize=512)
+_letter_cache_lock = threading.Lock()
+
+@lru_cache(maxsize=2)
+def _today_str(ordinal: int) -> str:
+    # strftime does locale-aware month lookup; the result only changes at
+    # midnight, so memoize on the day's ordinal
+    return date.fromordinal(ordinal).strftime("%B %d, %Y")
+
+def _letter_response(letter_content: str) -> dict:
+    return {
+        "success": True,
+        "complaint_letter": letter_content,
+        "safety_reminder": "Please keep a copy of this document in a secure location.",
+        "next_steps": [
+            "Review all information for accuracy",
+            "Make multiple copies for your records",
+            "Consider seeking legal counsel",
+            "Create a safety plan",
+            "Keep all related documentation"
+        ],
+        "immediate_help": {
+            "emergency": Config.EMERGENCY_HOTLINE,
+            "legal_aid": Config.LEGAL_AID_URL
+        }
+    }
 
 def format_evidence_description(evidence: Optional[str]) -> str:
     if not evidence:
         return "Documentation is available and can be provided upon request."
-    
-    evidence_points = evidence.split(", ")
-    if len(evidence_points) == 1:
+    if ", " not in evidence:
         return evidence
-    
-    return "\n".join(f"- {point}" for point in evidence_points)
+    return "- " + evidence.replace(", ", "\n- ")
 
 @app.post("/api/generate-complaint")
-async def generate_complaint_letter(complaint_info: ComplaintInfo):
+def generate_complaint_letter(complaint_info: ComplaintInfo):
     try:
-        if complaint_info.filing_type == "third_party":
-            if not all([complaint_info.victim_name, 
-                       complaint_info.victim_address, 
-                       complaint_info.relationship_to_victim]):
-                raise HTTPException(
-                    status_code=400,
-                    detail="Third-party complaints require victim name, address, and relationship details"
-                )
-            
-            filing_capacity = f"""I am filing this complaint on behalf of {complaint_info.victim_name}, 
-as their {complaint_info.relationship_to_victim}. I have direct knowledge of the incidents 
-described herein and am deeply concerned for their safety and well-being."""
-            
-            victim_information = f"""
-Victim Information:
-Name: {complaint_info.victim_name}
-Address: {complaint_info.victim_address}
-"""
-        else:
-            filing_capacity = "I am the direct victim of the incidents described in this complaint."
-            victim_information = ""
-
-        evidence_section = f"""
-Supporting Evidence:
-{format_evidence_description(complaint_info.evidence_description)}
-"""
-
-        witness_section = """
-Witness Information:
-""" + (complaint_info.witness_information or "Witness details can be provided as needed with appropriate privacy protections.")
-
-        confidentiality_statement = """
-I request that my personal information and the details of this complaint be handled with strict confidentiality 
-to ensure my safety and protection."""
-
-        authority_title = complaint_info.filing_authority.split()[-1] if len(complaint_info.filing_authority.split()) > 1 else "Sir/Madam"
-
-        letter_content = COMPLAINT_LETTER_TEMPLATE.format(
-            current_date=datetime.now().strftime("%B %d, %Y"),
+        # Key on every model field plus today's date: the date appears in the
+        # letter, so cached renders roll over naturally at midnight
+        today = date.today().toordinal()
+        cache_key = hashlib.sha256(
+            f"{today}:{complaint_info.model_dump_json()}".encode()
+        ).hexdigest()
+        with _letter_cache_lock:
+            cached = _letter_cache.get(cache_key)
+        if cached is not None:
+            return _letter_response(cached)
+
+        authority_parts = complaint_info.filing_authority.split()
+        authority_title = authority_parts[-1] if len(authority_parts) > 1 else "Sir/Madam"
+
+        letter_content = _LETTER_TPL.render(
+            current_date=_today_str(today),
             complainant_name=complaint_info.complainant_name,
             complainant_address=complaint_info.complainant_address,
-            contact_section=create_contact_section(complaint_info),
+            complainant_email=complaint_info.complainant_email,
+            complainant_contact=complaint_info.complainant_contact,
             filing_authority=complaint_info.filing_authority,
             filing_authority_address=complaint_info.filing_authority_address,
             authority_title=authority_title,
             incident_date=complaint_info.date_of_incident,
             incident_time=complaint_info.time_of_incident,
             incident_location=complaint_info.location_of_incident,
-            filing_capacity=filing_capacity,
+            filing_type=complaint_info.filing_type,
+            victim_name=complaint_info.victim_name,
+            victim_address=complaint_info.victim_address,
+            relationship_to_victim=complaint_info.relationship_to_victim,
             incident_narrative=complaint_info.incident_details,
-            injuries_section=create_injuries_section(complaint_info.injuries_sustained),
-            evidence_section=evidence_section,
-            witness_section=witness_section,
-            additional_requests="5. Provision of necessary support services and resources" if complaint_info.filing_type == "self" else "",
-            confidentiality_statement=confidentiality_statement,
-            contact_details=f"Contact: {complaint_info.complainant_contact}" if complaint_info.complainant_contact else "",
-            victim_information=victim_information
+            injuries=complaint_info.injuries_sustained,
+            evidence=format_evidence_description(complaint_info.evidence_description),
+            witnesses=complaint_info.witness_information or "Witness details can be provided as needed with appropriate privacy protections."
         )
 
-        return {
-            "success": True,
-            "complaint_letter": letter_content,
-            "safety_reminder": "Please keep a copy of this document in a secure location.",
-            "next_steps": [
-                "Review all information for accuracy",
-                "Make multiple copies for your records",
-                "Consider seeking legal counsel",
-                "Create a safety plan",
-                "Keep all related documentation"
-            ],
-            "immediate_help": {
-                "emergency": Config.EMERGENCY_HOTLINE,
-                "legal_aid": Config.LEGAL_AID_URL
-            }
-        }
+        with _letter_cache_lock:
+            _letter_cache[cache_key] = letter_content
+
+        return _letter_response(letter_content)
 
     except Exception as e:
         if Config.DEBUG:
@@ -238,38 +312,44 @@ to ensure my safety and protection."""
             detail="We encountered an issue processing your request. If you're in immediate danger, please contact emergency services."
         )
 
+def _sse(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+
 @app.post("/api/support-chat")
 async def get_support_chat(message: SupportMessage):
     try:
-        # Initialize chat history for new sessions
-        if message.session_id not in chat_histories:
-            chat_histories[message.session_id] = []
-        
-        # Get chat history
-        history = chat_histories[message.session_id]
-        
+        key = f"chat:{message.session_id}"
+
+        # Last 5 messages for prompt context; the full history stays in Redis
+        history = [json.loads(item) for item in await r.lrange(key, -5, -1)]
+
         # Format history for the prompt
         history_text = "\n".join([
             f"{'User' if msg['isUser'] else 'Assistant'}: {msg['text']}"
-            for msg in history[-5:]  # Keep last 5 messages for context
+            for msg in history
         ])
-        
+
+        # Only consult the cache on opening messages; later turns depend on
+        # conversation context and would misfire on a context-free match
+        first_message = len(history) == 0
+        if first_message:
+            hit = await run_in_threadpool(llmcache.check, prompt=message.message, num_results=1)
+            if hit:
+                cached_text = hit[0]["response"]
+                await _store_turn(key, message.message, cached_text)
+
+                async def replay():
+                    yield _sse({"delta": cached_text, "session_id": message.session_id})
+                    yield "data: [DONE]\n\n"
+
+                return StreamingResponse(replay(), media_type="text/event-stream")
+
         # Generate response with context
         prompt = SUPPORT_CHAT_PROMPT.format(
             history=history_text,
             message=message.message
         )
-        
-        response = model.generate_content(prompt)
-        
-        # Store the conversation
-        history.append({"text": message.message, "isUser": True})
-        history.append({"text": response.text, "isUser": False})
-        
-        return {
-            "response": response.text,
-            "session_id": message.session_id
-        }
     except Exception as e:
         if Config.DEBUG:
             raise HTTPException(status_code=500, detail=str(e))
@@ -278,11 +358,48 @@ async def get_support_chat(message: SupportMessage):
             detail="We're having trouble processing your message. If you need immediate help, please call " + Config.EMERGENCY_HOTLINE
         )
 
+    async def generate():
+        chunks = []
+        try:
+            async with _gemini_sem:
+                stream = await model.generate_content_async(prompt, stream=True)
+                async for chunk in stream:
+                    if chunk.text:
+                        chunks.append(chunk.text)
+                        yield _sse({"delta": chunk.text, "session_id": message.session_id})
+
+            response_text = "".join(chunks)
+            if first_message:
+                await run_in_threadpool(llmcache.store, prompt=message.message, response=response_text)
+
+            # Store the conversation
+            await _store_turn(key, message.message, response_text)
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            # Headers are already sent mid-stream, so errors surface as an
+            # SSE event rather than an HTTP status
+            if Config.DEBUG:
+                yield _sse({"error": str(e)})
+            else:
+                yield _sse({"error": "We're having trouble processing your message. If you need immediate help, please call " + Config.EMERGENCY_HOTLINE})
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
 @app.get("/api/chat-history/{session_id}")
-async def get_chat_history(session_id: str):
-    if session_id not in chat_histories:
-        return {"messages": []}
-    return {"messages": chat_histories[session_id]}
+async def get_chat_history(session_id: str, request: Request, response: Response):
+    raw = await r.lrange(f"chat:{session_id}", 0, -1)
+    messages = [json.loads(item) for item in raw]
+
+    # UIs poll this endpoint; an ETag over length + last message lets an
+    # unchanged history answer with a bodyless 304
+    last_text = messages[-1]["text"] if messages else ""
+    etag = hashlib.md5(f"{len(messages)}:{last_text}".encode()).hexdigest()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, max-age=2"
+    return {"messages": messages}
 
 @app.options("/api/support-chat")
 async def options_support_chat():